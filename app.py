@@ -1,9 +1,13 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from pathlib import Path
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 import calendar
+import csv
 import json
+import os
+from typing import Optional
 
 st.set_page_config(page_title="Spending Diary", layout="wide")
 
@@ -24,7 +28,11 @@ CATEGORIES = [
 DATA_PATH = Path("spending_diary.csv")
 BUDGETS_PATH = Path("monthly_budgets.json")
 
-SPEND_COLS = ["date", "notes"] + [f"{c}_spend" for c in CATEGORIES]
+SPEND_COL_NAMES = tuple(f"{c}_spend" for c in CATEGORIES)
+TITLED_CATEGORIES = tuple(c.title() for c in CATEGORIES)
+SPEND_COLS = ["date", "notes"] + list(SPEND_COL_NAMES)
+# Column dtypes handed to the CSV parser so no post-load coercion pass is needed
+SPEND_DTYPES = {"notes": str, **dict.fromkeys(SPEND_COL_NAMES, "float64")}
 
 # -----------------------------
 # Helpers
@@ -32,38 +40,101 @@ SPEND_COLS = ["date", "notes"] + [f"{c}_spend" for c in CATEGORIES]
 def month_key(d: date) -> str:
     return f"{d.year:04d}-{d.month:02d}"
 
+def week_key(d: date) -> str:
+    # ISO weeks are Monday-based, same as week_start/week_end
+    year, week, _ = d.isocalendar()
+    return f"{year:04d}-W{week:02d}"
+
 def ensure_files():
     if not DATA_PATH.exists():
         pd.DataFrame(columns=SPEND_COLS).to_csv(DATA_PATH, index=False)
     if not BUDGETS_PATH.exists():
         BUDGETS_PATH.write_text(json.dumps({}, indent=2))
 
-def load_spend_df() -> pd.DataFrame:
-    df = pd.read_csv(DATA_PATH)
+def read_spend_csv(path_str: str) -> pd.DataFrame:
+    try:
+        df = pd.read_csv(path_str, dtype=SPEND_DTYPES, parse_dates=["date"])
+    except ValueError:
+        # a non-numeric spend cell (hand-edited file): parse untyped and coerce to 0
+        df = pd.read_csv(path_str, dtype={"notes": str}, parse_dates=["date"])
+        spend_cols = [col for col in df.columns if col.endswith("_spend")]
+        df[spend_cols] = df[spend_cols].apply(pd.to_numeric, errors="coerce")
     if len(df) == 0:
         return df
-    df["date"] = pd.to_datetime(df["date"]).dt.date
-    for c in CATEGORIES:
-        col = f"{c}_spend"
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0.0)
+    # rows are only ever appended, so the last row for a date is the current one
+    n_rows = len(df)
+    df = df.drop_duplicates("date", keep="last")
+    df["date"] = df["date"].dt.date
+    spend_cols = [col for col in df.columns if col.endswith("_spend")]
+    df[spend_cols] = df[spend_cols].fillna(0.0)
     if "notes" not in df.columns:
         df["notes"] = ""
-    return df.sort_values("date")
+    else:
+        df["notes"] = df["notes"].fillna("")
+    # notes repeat a lot ("lunch", "coffee", blank), so store them as categories
+    df["notes"] = df["notes"].astype("category")
+    df = df.sort_values("date").reset_index(drop=True)
+    df.attrs["file_rows"] = n_rows
+    return df
+
+@st.cache_data(max_entries=1)
+def _load_spend_df_cached(path_str: str, mtime: float) -> pd.DataFrame:
+    # mtime is only part of the cache key: a new write invalidates the entry
+    return read_spend_csv(path_str)
+
+def spend_mtime() -> float:
+    return DATA_PATH.stat().st_mtime
 
-def save_spend_row(row: dict):
-    df = load_spend_df()
-    # if same date exists, overwrite (diary-like)
-    if len(df) > 0 and (df["date"] == row["date"]).any():
-        df = df[df["date"] != row["date"]]
-    df = pd.concat([df, pd.DataFrame([row])], ignore_index=True).sort_values("date")
-    df.to_csv(DATA_PATH, index=False)
+def load_spend_df() -> pd.DataFrame:
+    return _load_spend_df_cached(str(DATA_PATH), spend_mtime())
+
+def spend_row_frame(row: dict) -> pd.DataFrame:
+    # explicit float64 columns so concat onto the diary needs no dtype inference
+    return pd.DataFrame({
+        "date": [row["date"]],
+        "notes": [row["notes"]],
+        **{col: np.array([row[col]], dtype=np.float64) for col in SPEND_COL_NAMES},
+    })
 
-def load_budgets() -> dict:
-    return json.loads(BUDGETS_PATH.read_text())
+def compact_spend_file():
+    # re-read right before writing so rows appended by other sessions are kept,
+    # and swap in a temp file so a crash never leaves a partial diary
+    df = read_spend_csv(str(DATA_PATH))
+    tmp = DATA_PATH.with_suffix(".csv.tmp")
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, DATA_PATH)
+
+def save_spend_row(row: dict, df: pd.DataFrame):
+    # a hand-edited file may lack a final newline; add one so the row isn't joined on
+    with open(DATA_PATH, "a+b") as f:
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+    # append only; a row for an existing date overwrites it on load (diary-like)
+    with open(DATA_PATH, "a", newline="") as f:
+        csv.writer(f, lineterminator="\n").writerow([row[col] for col in SPEND_COLS])
+    file_rows = df.attrs.get("file_rows", len(df)) + 1
+    if file_rows - len(df) > len(df):
+        # mostly superseded rows: compact the file back to one row per date
+        compact_spend_file()
+
+@st.cache_data(max_entries=1)
+def _load_budgets_cached(path_str: str, mtime: float) -> dict:
+    return json.loads(Path(path_str).read_text())
 
-def save_budgets(budgets: dict):
-    BUDGETS_PATH.write_text(json.dumps(budgets, indent=2))
+def load_budgets() -> dict:
+    return _load_budgets_cached(str(BUDGETS_PATH), BUDGETS_PATH.stat().st_mtime)
+
+def save_budgets(budgets: dict) -> bool:
+    # compare against what is on disk (cached on mtime), not what this session last wrote
+    if budgets == load_budgets():
+        return False
+    # write to a temp file and swap it in so a crash never leaves a partial file
+    tmp = BUDGETS_PATH.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(budgets, sort_keys=True))
+    os.replace(tmp, BUDGETS_PATH)
+    return True
 
 def get_month_bounds(d: date):
     last_day = calendar.monthrange(d.year, d.month)[1]
@@ -73,34 +144,79 @@ def get_month_bounds(d: date):
 
 def week_start(d: date) -> date:
     # Monday-based weeks
-    return d - pd.Timedelta(days=d.weekday())
+    return d - timedelta(days=d.weekday())
 
 def week_end(d: date) -> date:
-    return week_start(d) + pd.Timedelta(days=6)
+    return week_start(d) + timedelta(days=6)
 
-def weeks_in_month(d: date) -> list[tuple[date, date]]:
-    # All Monday-Sunday weeks that intersect the month
+def num_weeks_in_month(d: date) -> int:
+    # Number of Monday-Sunday weeks that intersect the month
     m_start, m_end = get_month_bounds(d)
-    ws = week_start(m_start)
-    we = week_end(m_end)
-    weeks = []
-    cur = ws
-    while cur <= we:
-        weeks.append((cur, cur + pd.Timedelta(days=6)))
-        cur = cur + pd.Timedelta(days=7)
-    return weeks
+    return ((week_end(m_end) - week_start(m_start)).days // 7) + 1
 
 def filter_df_by_range(df: pd.DataFrame, start_d: date, end_d: date) -> pd.DataFrame:
     if len(df) == 0:
         return df
-    return df[(df["date"] >= start_d) & (df["date"] <= end_d)].copy()
-
-def totals_by_category(df: pd.DataFrame) -> dict:
-    out = {}
-    for c in CATEGORIES:
-        col = f"{c}_spend"
-        out[c] = float(df[col].sum()) if (len(df) and col in df.columns) else 0.0
-    return out
+    # df is sorted by date, so the range is a contiguous slice
+    arr = df["date"].to_numpy()
+    lo = np.searchsorted(arr, start_d, "left")
+    hi = np.searchsorted(arr, end_d, "right")
+    return df.iloc[lo:hi]
+
+def find_spend_row(df: pd.DataFrame, d: date) -> Optional[dict]:
+    # df is sorted by date with one row per date, so a binary search finds it
+    arr = df["date"].to_numpy()
+    i = np.searchsorted(arr, d, "left")
+    return df.iloc[i].to_dict() if i < len(arr) and arr[i] == d else None
+
+def totals_by_key(df: pd.DataFrame, keys: pd.Series) -> dict:
+    # df is sorted by date, so each period key covers a contiguous run of rows
+    # and all periods can be summed in one pass over the spend block
+    vals = df[list(SPEND_COL_NAMES)].to_numpy(dtype=np.float64)
+    key_arr = keys.to_numpy()
+    starts = np.flatnonzero(np.r_[True, key_arr[1:] != key_arr[:-1]])
+    sums = np.add.reduceat(vals, starts, axis=0)
+    return {key_arr[i]: dict(zip(CATEGORIES, v)) for i, v in zip(starts, sums.tolist())}
+
+@st.cache_data(max_entries=1)
+def monthly_and_weekly_sums(mtime: float, _df: pd.DataFrame) -> tuple[dict, dict]:
+    # _df is not hashed by st.cache_data; mtime identifies its contents
+    if len(_df) == 0:
+        return {}, {}
+    monthly = totals_by_key(_df, _df["date"].map(month_key))
+    weekly = totals_by_key(_df, _df["date"].map(week_key))
+    return monthly, weekly
+
+@st.cache_data(max_entries=16)
+def build_summary(df_mtime: float, selected_date: date, allocations_items: tuple, _df: pd.DataFrame):
+    # _df is not hashed by st.cache_data; df_mtime identifies its contents
+    allocations = dict(allocations_items)
+    num_weeks = num_weeks_in_month(selected_date)
+    weekly_budget = {c: (allocations[c] / num_weeks if num_weeks else 0.0) for c in CATEGORIES}
+
+    monthly_sums, weekly_sums = monthly_and_weekly_sums(df_mtime, _df)
+    no_spend = {c: 0.0 for c in CATEGORIES}
+    week_totals = weekly_sums.get(week_key(selected_date), no_spend)
+    month_totals = monthly_sums.get(month_key(selected_date), no_spend)
+
+    summary_rows = []
+    for c, title in zip(CATEGORIES, TITLED_CATEGORIES):
+        wb = weekly_budget[c]
+        ws_spent = week_totals[c]
+        ms_budget = allocations[c]
+        ms_spent = month_totals[c]
+        summary_rows.append({
+            "Category": title,
+            "Weekly budget": wb,
+            "Spent this week": ws_spent,
+            "Weekly remaining": wb - ws_spent,
+            "Monthly budget": ms_budget,
+            "Spent this month": ms_spent,
+            "Monthly remaining": ms_budget - ms_spent,
+        })
+
+    summary = pd.DataFrame(summary_rows)
+    return summary, weekly_budget, week_totals, month_totals, num_weeks
 
 # -----------------------------
 # Init
@@ -156,25 +272,17 @@ c3.metric("Unallocated", f"${leftover:,.2f}")
 
 if st.button("💾 Save monthly setup"):
     budgets[mkey] = {"income": float(income), "allocations": {k: float(v) for k, v in allocations.items()}}
-    save_budgets(budgets)
-    st.success("Saved monthly setup!")
-
-# -----------------------------
-# Weekly budget calculation
-# -----------------------------
-weeks = weeks_in_month(selected_date)
-num_weeks = len(weeks)
-
-weekly_budget = {c: (allocations[c] / num_weeks if num_weeks else 0.0) for c in CATEGORIES}
+    if save_budgets(budgets):
+        st.success("Saved monthly setup!")
+    else:
+        st.info("Monthly setup unchanged, nothing to save.")
 
 st.subheader("2) Daily diary log")
 
 # -----------------------------
 # Daily log form
 # -----------------------------
-existing_row = None
-if len(df) > 0 and (df["date"] == selected_date).any():
-    existing_row = df[df["date"] == selected_date].iloc[0].to_dict()
+existing_row = find_spend_row(df, selected_date)
 
 with st.form("daily_log", clear_on_submit=False):
     st.write(f"Logging for: **{selected_date}**")
@@ -182,11 +290,11 @@ with st.form("daily_log", clear_on_submit=False):
 
     spend_inputs = {}
     spend_cols = st.columns(4)
-    for i, c in enumerate(CATEGORIES):
-        default_val = float(existing_row.get(f"{c}_spend", 0.0)) if existing_row else 0.0
+    for i, (c, col, title) in enumerate(zip(CATEGORIES, SPEND_COL_NAMES, TITLED_CATEGORIES)):
+        default_val = float(existing_row.get(col, 0.0)) if existing_row else 0.0
         with spend_cols[i % 4]:
             spend_inputs[c] = st.number_input(
-                f"{c.title()} spend ($)",
+                f"{title} spend ($)",
                 min_value=0.0,
                 step=1.0,
                 value=default_val,
@@ -196,11 +304,13 @@ with st.form("daily_log", clear_on_submit=False):
     submitted = st.form_submit_button("✅ Save day")
     if submitted:
         row = {"date": selected_date, "notes": notes}
-        for c in CATEGORIES:
-            row[f"{c}_spend"] = float(spend_inputs[c])
-        save_spend_row(row)
+        for c, col in zip(CATEGORIES, SPEND_COL_NAMES):
+            row[col] = float(spend_inputs[c])
+        save_spend_row(row, df)
         st.success("Saved!")
-        df = load_spend_df()  # refresh
+        # refresh the already-parsed frame rather than re-reading the file
+        df = df[df["date"] != selected_date]
+        df = pd.concat([df, spend_row_frame(row)], ignore_index=True).sort_values("date").reset_index(drop=True)
 
 # -----------------------------
 # 3) Dashboard summaries
@@ -217,41 +327,18 @@ ms, me = get_month_bounds(selected_date)
 week_df = filter_df_by_range(df, ws, we)
 month_df = filter_df_by_range(df, ms, me)
 
-week_totals = totals_by_category(week_df)
-month_totals = totals_by_category(month_df)
-
-# Build summary table
-summary_rows = []
-for c in CATEGORIES:
-    wb = weekly_budget[c]
-    ws_spent = week_totals[c]
-    ms_budget = allocations[c]
-    ms_spent = month_totals[c]
-    summary_rows.append({
-        "Category": c.title(),
-        "Weekly budget": wb,
-        "Spent this week": ws_spent,
-        "Weekly remaining": wb - ws_spent,
-        "Monthly budget": ms_budget,
-        "Spent this month": ms_spent,
-        "Monthly remaining": ms_budget - ms_spent,
-    })
-
-summary = pd.DataFrame(summary_rows)
+summary, weekly_budget, week_totals, month_totals, num_weeks = build_summary(
+    spend_mtime(), selected_date, tuple(sorted(allocations.items())), df
+)
 
 left, right = st.columns([1.2, 1])
 
 with left:
     st.write(f"**Week:** {ws} → {we}  |  **Month:** {ms} → {me}  |  Weeks in month: **{num_weeks}**")
+    # format money via column_config: no Styler HTML, and columns still sort numerically
     st.dataframe(
-        summary.style.format({
-            "Weekly budget": "${:,.2f}",
-            "Spent this week": "${:,.2f}",
-            "Weekly remaining": "${:,.2f}",
-            "Monthly budget": "${:,.2f}",
-            "Spent this month": "${:,.2f}",
-            "Monthly remaining": "${:,.2f}",
-        }),
+        summary,
+        column_config={col: st.column_config.NumberColumn(format="dollar") for col in summary.columns.drop("Category")},
         use_container_width=True
     )
 
@@ -268,7 +355,7 @@ with right:
     # simple charts
     if len(week_df) > 0:
         chart_week = pd.DataFrame({
-            "Category": [c.title() for c in CATEGORIES],
+            "Category": list(TITLED_CATEGORIES),
             "Spent": [week_totals[c] for c in CATEGORIES],
             "Budget": [weekly_budget[c] for c in CATEGORIES],
         }).set_index("Category")
@@ -280,8 +367,9 @@ if len(month_df) == 0:
 else:
     show = month_df.copy()
     # show only non-zero spends + notes
-    show["total_spend"] = show[[f"{c}_spend" for c in CATEGORIES]].sum(axis=1)
+    vals = show[list(SPEND_COL_NAMES)].to_numpy(dtype=np.float64, copy=False)
+    show["total_spend"] = vals.sum(axis=1)
     show = show.sort_values("date", ascending=False)
-    st.dataframe(show[["date", "notes", "total_spend"] + [f"{c}_spend" for c in CATEGORIES]], use_container_width=True)
+    st.dataframe(show[["date", "notes", "total_spend", *SPEND_COL_NAMES]], use_container_width=True)
 
 st.caption("Data stored locally in spending_diary.csv + monthly_budgets.json")